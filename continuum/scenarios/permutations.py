@@ -54,7 +54,7 @@ class Permutations(TransformationIncremental):
 
         return [PermutationTransform(seed=None)] + [PermutationTransform(seed=int(s)) for s in seed]
 
-    def get_task_transformation(self, task_index):
+    def _build_task_transformation(self, task_index):
         return transforms.Compose(self.trsf.transforms + [self.inc_trsf[task_index]])
 
 
@@ -1,11 +1,15 @@
 import warnings
 from copy import copy
-from typing import Callable, List, Union, Optional
+import functools
+from typing import Callable, List, Tuple, Union, Optional
+import hashlib
+import itertools
 import os
 import multiprocessing
 
 import numpy as np
 from PIL import Image
+import torch
 import torchvision
 
 from continuum.datasets import _ContinuumDataset
@@ -45,7 +49,8 @@ class SegmentationClassIncremental(ClassIncremental):
                  "overlap" only pixels of the current classes are labelized.
     :param save_indexes: Path where to save and load the indexes of the different
                          tasks. Computing it may be slow, so it can be worth to
-                         checkpoint those.
+                         checkpoint those. If it is an existing folder, the
+                         indexes are cached there per dataset and setting.
     :param test_background: Whether to ignore the background (0) during the testing
                             phase (False) or to keep its label (True).
     """
@@ -66,6 +71,7 @@ class SegmentationClassIncremental(ClassIncremental):
         self.save_indexes = save_indexes
         self.test_background = test_background
         self._nb_classes = nb_classes
+        self._label_trsfs = {}
 
         if cl_dataset.data_type != TaskType.SEGMENTATION:
             raise ValueError(
@@ -137,7 +143,31 @@ class SegmentationClassIncremental(ClassIncremental):
         """
         if isinstance(task_index, int):
             task_index = [task_index]
-        if not self.train:
+
+        # Cached per scenario, as it is identical across epochs
+        key = (tuple(task_index), self.train, self.test_background)
+        if key not in self._label_trsfs:
+            self._label_trsfs[key] = self._build_label_transformation(*key)
+        return self._label_trsfs[key]
+
+    def _build_label_transformation(
+        self,
+        task_index: Tuple[int, ...],
+        train: bool,
+        test_background: bool
+    ):
+        """Builds the transformation to apply on the GT segmentation maps.
+
+        It only depends on the selected tasks, and on the train &
+        test_background options.
+
+        :param task_index: The selected task ids.
+        :param train: Whether the dataset is in training mode.
+        :param test_background: See the scenario doc.
+        :return: A pytorch transformation.
+        """
+        task_index = list(task_index)
+        if not train:
             # In testing mode, all labels brought by previous tasks are revealed
             task_index = list(range(max(task_index) + 1))
 
@@ -150,21 +180,24 @@ class SegmentationClassIncremental(ClassIncremental):
         else:
             raise ValueError(f"Unknown mode={self.mode}.")
 
-        inverted_order = {label: self.class_order.index(label) + 1 for label in labels}
+        inverted_order = dict(zip(labels, self._class_to_pos[labels].tolist()))
         inverted_order[255] = 255
 
         masking_value = 0
-        if not self.train:
-            if self.test_background:
+        if not train:
+            if test_background:
                 inverted_order[0] = 0
             else:
                 masking_value = 255
 
-        return torchvision.transforms.Lambda(
-            lambda seg_map: seg_map.apply_(
-                lambda v: inverted_order.get(v, masking_value)
-            )
-        )
+        # A lookup table remaps all pixels at once, instead of a Python call per pixel
+        lut = torch.full((256,), masking_value, dtype=torch.uint8)
+        for label, new_label in inverted_order.items():
+            lut[label] = new_label
+
+        # A partial of a module-level function, unlike a lambda, can be pickled
+        # to DataLoader workers started with "spawn".
+        return torchvision.transforms.Lambda(functools.partial(_remap_labels, lut))
 
     def _get_task_ids(self, t: np.ndarray, task_indexes: Union[int, List[int]]) -> np.ndarray:
         """Reduce multiple task ids to a single one per sample.
@@ -190,14 +223,12 @@ class SegmentationClassIncremental(ClassIncremental):
         if isinstance(task_indexes, int):
             task_indexes = [task_indexes]
 
-        labels = set()
+        labels = []
         for t in task_indexes:
-           previous_inc = sum(self._increments[:t])
-           labels.update(
-               self.class_order[previous_inc:previous_inc+self._increments[t]]
-           )
+            start, end = self._increment_prefix[t], self._increment_prefix[t + 1]
+            labels.extend(self.class_order[start:end])
 
-        return list(labels)
+        return labels
 
     def _setup(self, nb_tasks: int) -> int:
         """Setups the different tasks."""
@@ -211,15 +242,22 @@ class SegmentationClassIncremental(ClassIncremental):
             if c in (0, 255): return c
             return self.class_order[c - 1]
         self._class_mapping = np.vectorize(class_mapping)
+        # And the inverse, the new label (position in the order + 1) of each class
+        self._class_to_pos = np.zeros(max(self.class_order) + 1, dtype=np.int64)
+        self._class_to_pos[self.class_order] = np.arange(1, len(self.class_order) + 1)
 
         self._increments = self._define_increments(
             self.increment, self.initial_increment, self.class_order
         )
+        # Start & end (exclusive) position of each task's classes in the class order
+        self._increment_prefix = [0] + list(itertools.accumulate(self._increments))
 
         # Checkpointing the indexes if the option is enabled.
         # The filtering can take multiple minutes, thus saving/loading them can
         # be useful.
-        if self.save_indexes is not None and os.path.exists(self.save_indexes):
+        if self.save_indexes is not None and os.path.isdir(self.save_indexes):
+            t = self._cached_filter_images(y)
+        elif self.save_indexes is not None and os.path.exists(self.save_indexes):
             print(f"Loading previously saved indexes ({self.save_indexes}).")
             t = np.load(self.save_indexes)
         else:
@@ -236,12 +274,63 @@ class SegmentationClassIncremental(ClassIncremental):
 
         return len(self._increments)
 
+    def _cached_filter_images(self, paths: Union[np.ndarray, List[str]]) -> np.ndarray:
+        """Loads the task indexes from the `save_indexes` folder, or computes them.
+
+        The task indexes depend on the paths, increments, class order, and mode.
+        The classes present in each map only depend on the paths, thus they are
+        saved separately so that another setting on the same dataset doesn't
+        need to re-open all maps.
+
+        :param paths: An iterable of paths to gt maps.
+        :return: A binary matrix representing the task ids of shape (nb_samples, nb_tasks).
+        """
+        paths_key = _hash_key(tuple(paths))
+        key = _hash_key(paths_key, tuple(self._increments), tuple(self.class_order), self.mode)
+        filter_path = os.path.join(self.save_indexes, f"filter_{key}.npy")
+        classes_path = os.path.join(self.save_indexes, f"classes_{paths_key}.npz")
+
+        if os.path.exists(filter_path):
+            print(f"Loading previously saved indexes ({filter_path}).")
+            return np.load(filter_path, mmap_mode="r")
+
+        if os.path.exists(classes_path):
+            print(f"Loading previously saved classes ({classes_path}).")
+            with np.load(classes_path) as csr:
+                classes = csr["indptr"], csr["indices"]
+        else:
+            print("Computing indexes, it may be slow!")
+            classes = _find_all_classes(paths)
+            np.savez(classes_path, indptr=classes[0], indices=classes[1])
+
+        t = _filter_images(
+            paths, self._increments, self.class_order, self.mode, classes=classes
+        )
+        np.save(filter_path, t)
+        return t
+
+
+def _remap_labels(lut: torch.Tensor, seg_map: torch.Tensor) -> torch.Tensor:
+    """Remaps the labels of a segmentation map through a lookup table.
+
+    :param lut: A lookup table of shape (256,), giving the new label of each label.
+    :param seg_map: A segmentation map.
+    :return: The remapped segmentation map, of the same dtype.
+    """
+    return lut[seg_map.long()].to(seg_map.dtype)
+
+
+def _hash_key(*values) -> str:
+    """Hashes the string representation of some values into a file-safe key."""
+    return hashlib.blake2b(repr(values).encode("utf-8"), digest_size=16).hexdigest()
+
 
 def _filter_images(
     paths: Union[np.ndarray, List[str]],
     increments: List[int],
     class_order: List[int],
-    mode: str = "overlap"
+    mode: str = "overlap",
+    classes: Optional[Tuple[np.ndarray, np.ndarray]] = None
 ) -> np.ndarray:
     """Select images corresponding to the labels.
 
@@ -254,41 +343,97 @@ def _filter_images(
                         background class (0) and unknown class (255) aren't
                         in this class order.
     :param mode: Mode of the segmentation (see scenario doc).
+    :param classes: The classes present in each gt map in CSR format (see
+                    `_find_all_classes`), if already known. Otherwise the maps
+                    are opened.
     :return: A binary matrix representing the task ids of shape (nb_samples, nb_tasks).
     """
-    indexes_to_classes = []
-    pb = ProgressBar()
-
-    with multiprocessing.Pool(min(8, multiprocessing.cpu_count())) as pool:
-        for i, classes in enumerate(pool.imap(_find_classes, paths), start=1):
-            indexes_to_classes.append(classes)
-            if i % 100 == 0:
-                pb.update(None, 100, len(paths))
-        pb.end(len(paths))
-
-    t = np.zeros((len(paths), len(increments)))
+    if classes is None:
+        classes = _find_all_classes(paths)
+    indptr, indices = classes
+
+    if mode not in ("overlap", "disjoint", "sequential"):
+        raise ValueError(f"Unknown mode={mode}.")
+
+    # Each image's classes are packed as a bitmask in uint64 words, of shape
+    # (nb_samples, nb_words), so that the per-task filtering boils down to
+    # bitwise AND against the task's bitmask instead of a Python loop.
+    max_class = max(max(class_order), 255, int(indices.max()))
+    nb_words = (max_class + 64) // 64
+
+    rows = np.repeat(np.arange(len(paths)), np.diff(indptr))
+    indices = indices.astype(np.uint64)
+    bits = np.zeros((len(paths), nb_words), dtype=np.uint64)
+    np.bitwise_or.at(
+        bits, (rows, (indices >> np.uint64(6)).astype(np.int64)),
+        np.uint64(1) << (indices & np.uint64(63))
+    )
+
+    # Bitmasks of the labels of each task, and of the labels allowed in each
+    # task (previous and current ones, plus background & unknown), of shape
+    # (nb_tasks, nb_words).
+    labels_masks = np.zeros((len(increments), nb_words), dtype=np.uint64)
     accumulated_inc = 0
-
     for task_id, inc in enumerate(increments):
-        labels = class_order[accumulated_inc:accumulated_inc+inc]
-        old_labels = class_order[:accumulated_inc]
-        all_labels = labels + old_labels + [0, 255]
-
-        for index, classes in enumerate(indexes_to_classes):
-            if mode == "overlap":
-                if any(c in labels for c in classes):
-                    t[index, task_id] = 1
-            elif mode in ("disjoint", "sequential"):
-                if any(c in labels for c in classes) and all(c in all_labels for c in classes):
-                    t[index, task_id] = 1
-            else:
-                raise ValueError(f"Unknown mode={mode}.")
-
+        labels_masks[task_id] = _to_bitmask(
+            class_order[accumulated_inc:accumulated_inc+inc], nb_words
+        )
         accumulated_inc += inc
+    allowed_masks = np.bitwise_or.accumulate(labels_masks, axis=0) | _to_bitmask([0, 255], nb_words)
 
+    # All tasks are filtered at once, broadcasting to (nb_samples, nb_tasks, nb_words)
+    t = (bits[:, None] & labels_masks[None]).any(axis=2)
+    if mode in ("disjoint", "sequential"):
+        t &= ~(bits[:, None] & ~allowed_masks[None]).any(axis=2)
+
+    t = t.astype(np.uint8)
     return t
 
 
+def _to_bitmask(classes: List[int], nb_words: int) -> np.ndarray:
+    """Packs classes ids into a bitmask.
+
+    :param classes: Classes ids.
+    :param nb_words: Number of uint64 words of the bitmask.
+    :return: A bitmask of shape (nb_words,).
+    """
+    mask = np.zeros(nb_words, dtype=np.uint64)
+    for c in classes:
+        mask[c >> 6] |= np.uint64(1) << np.uint64(c & 63)
+    return mask
+
+
+def _find_all_classes(paths: Union[np.ndarray, List[str]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Open all ground-truth segmentation maps and returns their unique classes.
+
+    The classes are stored in CSR format: the classes of the i-th map are
+    `indices[indptr[i]:indptr[i + 1]]`.
+
+    :param paths: An iterable of paths to gt maps.
+    :return: The `indptr` (int64) and `indices` (uint16) arrays.
+    """
+    if len(paths) <= 512:
+        # Not worth spawning workers for so few images.
+        indexes_to_classes = [_find_classes(path) for path in paths]
+    else:
+        indexes_to_classes = []
+        pb = ProgressBar()
+
+        nb_workers = min(8, multiprocessing.cpu_count())
+        # Batch the paths sent to each worker to amortize the IPC cost.
+        chunksize = max(1, len(paths) // (8 * nb_workers))
+        with multiprocessing.Pool(nb_workers) as pool:
+            for i, classes in enumerate(pool.imap(_find_classes, paths, chunksize), start=1):
+                indexes_to_classes.append(classes)
+                if i % 100 == 0:
+                    pb.update(None, 100, len(paths))
+            pb.end(len(paths))
+
+    indptr = np.cumsum([0] + [len(c) for c in indexes_to_classes], dtype=np.int64)
+    indices = np.concatenate(indexes_to_classes).astype(np.uint16)
+    return indptr, indices
+
+
 def _find_classes(path: str) -> np.ndarray:
     """Open a ground-truth segmentation map image and returns all unique classes
     contained.
@@ -296,4 +441,9 @@ def _find_classes(path: str) -> np.ndarray:
     :param path: Path to the image.
     :return: Unique classes.
     """
-    return np.unique(np.array(Image.open(path)).reshape(-1))
+    image = Image.open(path)
+    if image.mode in ("L", "P"):
+        # At most 256 values, counted by PIL without materializing the array
+        colors = image.getcolors(maxcolors=256)
+        return np.sort(np.fromiter((c for _, c in colors), dtype=np.uint8, count=len(colors)))
+    return np.unique(np.array(image).reshape(-1))
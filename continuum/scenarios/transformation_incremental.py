@@ -46,20 +46,27 @@ class TransformationIncremental(InstanceIncremental):
 
         self.num_classes_per_task = len(np.unique(self.dataset[1]))  # the num of classes is the same for all task is this scenario
 
+        # Built once, rather than at every task access
+        self._task_trsfs = [self._build_task_transformation(ti) for ti in range(nb_tasks)]
+
     @property
     def nb_classes(self) -> int:
         """Total number of classes in the whole continual setting."""
         if self.shared_label_space:
-            nb_classes = len(np.unique(self.dataset[1]))
+            nb_classes = self.num_classes_per_task
         else:
-            nb_classes = len(np.unique(self.dataset[1])) * self._nb_tasks
+            nb_classes = self.num_classes_per_task * self._nb_tasks
         return nb_classes
 
     def get_task_transformation(self, task_index):
-        return transforms.Compose(self.inc_trsf[task_index] + self.trsf.transforms)
+        return self._task_trsfs[task_index]
+
+    def _build_task_transformation(self, task_index):
+        return transforms.Compose(self.inc_trsf[task_index] + list(self.trsf.transforms))
 
     def update_task_indexes(self, task_index):
-        new_t = np.ones(len(self.dataset[1])) * task_index
+        # Zero-copy, read-only view: all samples share the same task index
+        new_t = np.broadcast_to(np.int32(task_index), (len(self.dataset[1]),))
         self.dataset = (self.dataset[0], self.dataset[1], new_t)
 
     def update_labels(self, task_index):
@@ -96,9 +103,7 @@ class TransformationIncremental(InstanceIncremental):
 
         task_index = set([_handle_negative_indexes(ti, len(self)) for ti in task_index])
 
-        t = np.concatenate([
-            (np.ones(len(x)) * ti).astype(np.int32) for ti in task_index
-        ])
+        t = np.repeat(np.array(list(task_index), dtype=np.int32), len(x))
         x = np.concatenate([
             x for _ in range(len(task_index))
         ])
@@ -1,5 +1,6 @@
 import glob
 import os
+import pickle
 
 import numpy as np
 import pytest
@@ -150,6 +151,43 @@ def test_save_indexes(tmpdir):
     )
 
 
+def test_save_indexes_folder(tmpdir):
+    folder = os.path.join(tmpdir, "indexes")
+    os.makedirs(folder)
+
+    dataset = create_dataset(tmpdir, "seg_tmp")
+    scenario = SegmentationClassIncremental(
+        dataset,
+        nb_classes=4,
+        increment=2,
+        mode="overlap",
+        save_indexes=folder
+    )
+    lengths = [len(scenario[i]) for i in range(len(scenario))]
+    _clean(os.path.join(tmpdir, "seg_tmp*"))
+
+    # Same setting, the task indexes are loaded
+    scenario = SegmentationClassIncremental(
+        dataset,
+        nb_classes=4,
+        increment=2,
+        mode="overlap",
+        save_indexes=folder
+    )
+    assert [len(scenario[i]) for i in range(len(scenario))] == lengths
+
+    # Different setting, only the classes per map are loaded
+    scenario = SegmentationClassIncremental(
+        dataset,
+        nb_classes=4,
+        increment=1,
+        initial_increment=2,
+        mode="disjoint",
+        save_indexes=folder
+    )
+    assert [len(scenario[i]) for i in range(len(scenario))] == [5, 10, 5]
+
+
 def test_advanced_indexing_step(dataset):
     scenario = SegmentationClassIncremental(
         dataset,
@@ -410,3 +448,29 @@ def test_continuum_to_pytorch_dataset(dataset):
     c = 0
     for x, y, _ in loader:
         pass
+
+
+def test_pickable_label_transformation(dataset):
+    scenario = SegmentationClassIncremental(
+        dataset,
+        nb_classes=4,
+        increment=2,
+        mode="overlap"
+    )
+
+    for task_set in scenario:
+        task_set = pickle.loads(pickle.dumps(task_set))
+        for _, y, _ in DataLoader(task_set, batch_size=32):
+            pass
+
+
+def test_cached_label_transformation(dataset):
+    scenario = SegmentationClassIncremental(
+        dataset,
+        nb_classes=4,
+        increment=2,
+        mode="overlap"
+    )
+
+    assert scenario[0].target_trsf is scenario[0].target_trsf
+    assert scenario[0].target_trsf is not scenario[1].target_trsf